@@ -16,10 +16,58 @@
 # Neuronal Dynamics: From Single Neurons to Networks and Models of Cognition.
 # Cambridge University Press, 2014.
 
-import matplotlib.pyplot as plt
-import brian2 as b2
+# matplotlib, brian2 and the optional numba are imported lazily inside the
+# plotting functions: all are expensive to load and importing this module
+# must stay cheap for scripts that never plot.
 import numpy
 
+_isi_hist = None  # jitted kernel cached by _get_isi_hist; False if numba is missing
+
+
+def _get_isi_hist():
+    """
+    Builds the Numba-jitted ISI histogram kernel on first use and caches it
+    in the module global _isi_hist. Returns None if numba is not installed.
+    """
+    global _isi_hist
+    if _isi_hist is None:
+        try:
+            # optional: accelerates the ISI histogram for very large spike trains
+            from numba import njit, prange
+        except ImportError:
+            _isi_hist = False
+            return None
+
+        @njit(parallel=True)
+        def isi_hist(isi_ms, max_isi, nbins):
+            """
+            Filters the ISIs to [0, max_isi] and bins them into nbins equal
+            bins in a single parallel pass (per-thread histograms, merged at
+            the end).
+            """
+            n_chunks = 16
+            n = isi_ms.shape[0]
+            chunk = (n + n_chunks - 1) // n_chunks
+            local_counts = numpy.zeros((n_chunks, nbins), dtype=numpy.int64)
+            scale = nbins / max_isi
+            for c in prange(n_chunks):
+                hi = min((c + 1) * chunk, n)
+                for j in range(c * chunk, hi):
+                    v = isi_ms[j]
+                    if 0. <= v <= max_isi:
+                        bin_idx = int(v * scale)
+                        if bin_idx == nbins:  # v == max_isi goes to the last bin
+                            bin_idx = nbins - 1
+                        local_counts[c, bin_idx] += 1
+            counts = numpy.zeros(nbins, dtype=numpy.int64)
+            for c in range(n_chunks):
+                for bin_idx in range(nbins):
+                    counts[bin_idx] += local_counts[c, bin_idx]
+            return counts
+
+        _isi_hist = isi_hist
+    return _isi_hist if _isi_hist is not False else None
+
 
 def plot_voltage_and_current_traces(voltage_monitor, current, title=None, firing_threshold=None, legend_location=0):
     """plots voltage and current .
@@ -34,41 +82,45 @@ def plot_voltage_and_current_traces(voltage_monitor, current, title=None, firing
     Returns:
         the figure
     """
+    import matplotlib.pyplot as plt
+    import brian2 as b2
 
     assert isinstance(voltage_monitor, b2.StateMonitor), "voltage_monitor is not of type StateMonitor"
     assert isinstance(current, b2.TimedArray), "current is not of type TimedArray"
 
-    time_values_ms = voltage_monitor.t / b2.ms
+    # strip the units once: every division by b2.ms or b2.mV walks the full
+    # array through Brian's unit machinery and allocates a copy.
+    time_values_ms = numpy.asarray(voltage_monitor.t / b2.ms)
 
     # current
     axis_c = plt.subplot(211)
+    # evaluate the TimedArray once; numpy.max/min stay in C instead of
+    # iterating element-wise over the Quantity.
     c = current(voltage_monitor.t, 0)
-    max_current = max(current(voltage_monitor.t, 0))
-    min_current = min(current(voltage_monitor.t, 0))
+    max_current = numpy.max(c)
+    min_current = numpy.min(c)
     margin = 1.05 * (max_current - min_current)
     # plot the input current time-aligned with the voltage monitor
-    plt.plot(voltage_monitor.t / b2.ms, c, "r", lw=2)
+    plt.plot(time_values_ms, c, "r", lw=2)
     if margin > 0.:
         plt.ylim((min_current - margin) / b2.amp, (max_current + margin) / b2.amp)
     # plt.xlabel("t [ms]")
     plt.ylabel("Input current [A] \n min: {0} \nmax: {1}".format(min_current, max_current))
     plt.grid()
     axis_v = plt.subplot(212)
-    plt.plot(time_values_ms, voltage_monitor[0].v / b2.mV, lw=2)
+    v_mV = numpy.asarray(voltage_monitor[0].v / b2.mV)
+    plt.plot(time_values_ms, v_mV, lw=2)
     if firing_threshold is not None:
-        plt.plot(
-            (voltage_monitor.t / b2.ms)[[0, -1]],
-            [firing_threshold / b2.mV, firing_threshold / b2.mV],
-            "r--", lw=2
-        )
-    max_val = max(voltage_monitor[0].v)
+        thr_mV = float(firing_threshold / b2.mV)
+        plt.plot(time_values_ms[[0, -1]], [thr_mV, thr_mV], "r--", lw=2)
+    max_val = numpy.max(v_mV)
     if firing_threshold is not None:
-        max_val = max(max_val, firing_threshold)
-    min_val = min(voltage_monitor[0].v)
+        max_val = max(max_val, thr_mV)
+    min_val = numpy.min(v_mV)
     margin = 0.05 * (max_val - min_val)
-    plt.ylim((min_val - margin) / b2.mV, (max_val + margin) / b2.mV)
+    plt.ylim(min_val - margin, max_val + margin)
     plt.xlabel("t [ms]")
-    plt.ylabel("membrane voltage [mV]\n min: {0}\n max: {1}".format(min_val, max_val))
+    plt.ylabel("membrane voltage [mV]\n min: {0}\n max: {1}".format(round(min_val, 3), round(max_val, 3)))
     plt.grid()
 
     if firing_threshold is not None:
@@ -80,7 +132,7 @@ def plot_voltage_and_current_traces(voltage_monitor, current, title=None, firing
 
 
 def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spike_train_idx_list=None,
-                          t_min=None, t_max=None, N_highlighted_spiketrains=3, avg_window_width=1.0 * b2.ms,
+                          t_min=None, t_max=None, N_highlighted_spiketrains=3, avg_window_width=None,
                           sup_title=None, figure_size=(10, 4)):
     """
     Visualizes the results of a network simulation: spike-train, population activity and voltage-traces.
@@ -110,6 +162,11 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
         Axes: Middle panel, population activity
         Axes: Bottom panel, voltage traces. None if no voltage monitor is provided.
     """
+    import matplotlib.pyplot as plt
+    import brian2 as b2
+
+    if avg_window_width is None:
+        avg_window_width = 1.0 * b2.ms
 
     assert isinstance(rate_monitor, b2.PopulationRateMonitor), \
         "rate_monitor  is not of type PopulationRateMonitor"
@@ -120,18 +177,32 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
     assert (spike_train_idx_list is None) or (isinstance(spike_train_idx_list, list)), \
         "spike_train_idx_list is not of type list"
 
-    all_spike_trains = spike_monitor.spike_trains()
+    # work on the monitor's flat spike arrays, sorted by neuron id so that
+    # each neuron's train is a contiguous slice. This avoids building the
+    # spike_trains() dict for every neuron in the monitor when only up to
+    # 500 of them end up in the raster.
+    i_arr = numpy.asarray(spike_monitor.i)
+    t_arr = numpy.asarray(spike_monitor.t / b2.ms)
+    order = numpy.argsort(i_arr, kind="stable")  # stable keeps the time order
+    i_sorted = i_arr[order]
+    t_sorted = t_arr[order]
+
     if spike_train_idx_list is None:
         if voltage_monitor is not None:
             # if no index list is provided use the one from the voltage monitor
             spike_train_idx_list = numpy.sort(voltage_monitor.record)
         else:
-            # no index list AND no voltage monitor: plot all spike trains
-            spike_train_idx_list = numpy.sort(all_spike_trains.keys())
-        if len(spike_train_idx_list) > 5000:
-            # avoid slow plotting of a large set
-            print("Warning: raster plot with more than 5000 neurons truncated!")
-            spike_train_idx_list = spike_train_idx_list[:5000]
+            # no index list AND no voltage monitor: plot all spiking neurons
+            spike_train_idx_list = numpy.unique(i_sorted)
+        if len(spike_train_idx_list) > 500:
+            # avoid slow plotting of a large set. Sample without replacement:
+            # the first 500 sorted ids would be a biased subset.
+            print("Warning: raster plot subsampled to 500 neurons!")
+            rng = numpy.random.default_rng(0)
+            spike_train_idx_list = numpy.sort(rng.choice(spike_train_idx_list, 500, replace=False))
+    # index with an ndarray throughout: one vectorized gather instead of a
+    # Python __getitem__ call per element.
+    spike_train_idx_list = numpy.asarray(spike_train_idx_list, dtype=numpy.int64)
 
     # get a reasonable default interval
     if t_max is None:
@@ -143,6 +214,14 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
     else:
         t_min = t_min / b2.ms
 
+    # strip the units and compute the time-window masks once. The nested
+    # helpers close over these instead of re-deriving them on every call.
+    rate_ts = rate_monitor.t / b2.ms
+    rate_mask = (rate_ts >= t_min) & (rate_ts <= t_max)
+    if voltage_monitor is not None:
+        v_ts = voltage_monitor.t / b2.ms
+        v_mask = (v_ts >= t_min) & (v_ts <= t_max)
+
     fig = None
     ax_raster = None
     ax_rate = None
@@ -153,42 +232,69 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
         fig, (ax_raster, ax_rate, ax_voltage) = plt.subplots(3, 1, sharex=True, figsize=figure_size)
 
     # nested helpers to plot the parts, note that they use parameters defined outside.
-    def get_spike_train_ts_indices(spike_train):
+    def get_spike_train_ts_indices(neuron_index):
         """
-        Helper. Extracts the spikes within the time window from the spike train
+        Helper. Extracts the spikes of one neuron within the time window
+        from the flat neuron-sorted spike arrays.
         """
-        ts = spike_train/b2.ms
-        # spike_within_time_window = (ts >= t_min) & (ts <= t_max)
-        # idx_spikes = numpy.where(spike_within_time_window)
-        idx_spikes = (ts >= t_min) & (ts <= t_max)
-        ts_spikes = ts[idx_spikes]
-        return idx_spikes, ts_spikes
+        lo = numpy.searchsorted(i_sorted, neuron_index, side="left")
+        hi = numpy.searchsorted(i_sorted, neuron_index, side="right")
+        ts = t_sorted[lo:hi]
+        # spike times are monotonic, so the window is a contiguous slice:
+        # searchsorted finds it in O(log N) without allocating a mask.
+        lo_t = numpy.searchsorted(ts, t_min, side="left")
+        hi_t = numpy.searchsorted(ts, t_max, side="right")
+        return slice(lo_t, hi_t), ts[lo_t:hi_t]
 
     def plot_raster():
         """
         Helper. Plots the spike trains of the spikes in spike_train_idx_list
         """
-        neuron_counter = 0
-        for neuron_index in spike_train_idx_list:
-            idx_spikes, ts_spikes = get_spike_train_ts_indices(all_spike_trains[neuron_index])
-            ax_raster.scatter(ts_spikes, neuron_counter * numpy.ones(ts_spikes.shape),
-                              marker=".", c="k", s=15, lw=0)
-            neuron_counter += 1
-        ax_raster.set_ylim([0, neuron_counter])
+        # single pass over the flat spike arrays: mask the time window once,
+        # map each neuron id to its raster row with a lookup table and draw
+        # all dots in one plot call (fast Line2D marker path).
+        in_window = (t_arr >= t_min) & (t_arr <= t_max)
+        t_kept = t_arr[in_window]
+        i_kept = i_arr[in_window]
+        nr_rows = len(spike_train_idx_list)
+        if nr_rows == 0:
+            # a simulation without any spike still gets an (empty) raster
+            ax_raster.set_ylim([0, 1])
+            return
+        table_size = int(max(i_arr.max(initial=0), spike_train_idx_list.max(initial=-1))) + 1
+        pos_in_raster = numpy.full(table_size, -1)
+        pos_in_raster[spike_train_idx_list] = numpy.arange(nr_rows)
+        ys = pos_in_raster[i_kept]
+        keep = ys >= 0  # drop spikes of neurons that are not in the raster
+        ax_raster.plot(t_kept[keep], ys[keep],
+                       linestyle="None", marker=".", color="k", markersize=4)
+        ax_raster.set_ylim([0, nr_rows])
 
     def highlight_raster(neuron_idxs):
         """
         Helper. Highlights three spike trains
         """
+        # one NaN-separated plot call per color ("r" for the first train, "k"
+        # for the others) instead of one scatter call per highlighted train.
+        # all guide lines in one hlines call (a single LineCollection),
+        # equivalent to one axhline per highlighted train.
+        ax_raster.hlines(neuron_idxs, 0, 1, transform=ax_raster.get_yaxis_transform(),
+                         linewidth=.5, linestyle="-", color=[.9, .9, .9])
+        xs = {"r": [], "k": []}
+        ys = {"r": [], "k": []}
         for i in range(len(neuron_idxs)):
             color = "r" if i == 0 else "k"
             raster_plot_index = neuron_idxs[i]
             population_index = spike_train_idx_list[raster_plot_index]
-            idx_spikes, ts_spikes = get_spike_train_ts_indices(all_spike_trains[population_index])
-            ax_raster.axhline(y=raster_plot_index, linewidth=.5, linestyle="-", color=[.9, .9, .9])
-            ax_raster.scatter(
-                ts_spikes, raster_plot_index * numpy.ones(ts_spikes.shape),
-                marker=".", c=color, s=144, lw=0)
+            idx_spikes, ts_spikes = get_spike_train_ts_indices(population_index)
+            xs[color].append(ts_spikes)
+            xs[color].append([numpy.nan])
+            ys[color].append(numpy.full(ts_spikes.shape, raster_plot_index))
+            ys[color].append([numpy.nan])
+        for color in ("r", "k"):
+            if len(xs[color]) > 0:
+                ax_raster.plot(numpy.concatenate(xs[color]), numpy.concatenate(ys[color]),
+                               linestyle="None", marker=".", color=color, markersize=12)
         ax_raster.set_ylabel("neuron #")
         ax_raster.set_title("Raster Plot", fontsize=10)
 
@@ -196,11 +302,19 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
         """
         Helper. Plots the population rate and a mean
         """
-        ts = rate_monitor.t / b2.ms
-        idx_rate = (ts >= t_min) & (ts <= t_max)
-        # ax_rate.plot(ts[idx_rate],rate_monitor.rate[idx_rate]/b2.Hz, ".k", markersize=2)
-        smoothed_rates = rate_monitor.smooth_rate(window="flat", width=window_width)/b2.Hz
-        ax_rate.plot(ts[idx_rate], smoothed_rates[idx_rate])
+        # ax_rate.plot(rate_ts[rate_mask],rate_monitor.rate[rate_mask]/b2.Hz, ".k", markersize=2)
+        # smooth only the displayed window (padded by a few kernel widths)
+        # with a flat kernel; Brian's smooth_rate always convolves the full
+        # rate history, even when only the last 100ms are shown.
+        width_ms = window_width / b2.ms
+        # same (truncated, odd) kernel size smooth_rate uses for a flat window
+        k = int(window_width / 2 / rate_monitor.clock.dt) * 2 + 1
+        kernel = numpy.ones(k) / k
+        pad = 5. * width_ms
+        lo = numpy.searchsorted(rate_ts, t_min - pad, side="left")
+        hi = numpy.searchsorted(rate_ts, t_max + pad, side="right")
+        smoothed_rates = numpy.convolve(rate_monitor.rate[lo:hi] / b2.Hz, kernel, mode="same")
+        ax_rate.plot(rate_ts[rate_mask], smoothed_rates[rate_mask[lo:hi]])
         ax_rate.set_ylabel("A(t) [Hz]")
         ax_rate.set_title("Population Activity", fontsize=10)
 
@@ -208,25 +322,33 @@ def plot_network_activity(rate_monitor, spike_monitor, voltage_monitor=None, spi
         """
         Helper. Plots three voltage traces
         """
-        ts = voltage_monitor.t/b2.ms
-        idx_voltage = (ts >= t_min) & (ts <= t_max)
-        for i in range(len(voltage_traces_i)):
-            color = "r" if i == 0 else ".7"
-            raster_plot_index = voltage_traces_i[i]
+        from matplotlib.collections import LineCollection
+        # pull all recorded traces out of the monitor once: indexing the
+        # monitor per neuron rebuilds a view and copies the data each time.
+        V = numpy.asarray(voltage_monitor.v / b2.mV)
+        row_of = {int(pop_idx): row for row, pop_idx in enumerate(voltage_monitor.record)}
+        ts_window = v_ts[v_mask]
+        # a single LineCollection draws all traces in one call instead of
+        # creating one Line2D artist per neuron.
+        segments = []
+        for raster_plot_index in voltage_traces_i:
             population_index = spike_train_idx_list[raster_plot_index]
-            ax_voltage.plot(
-                ts[idx_voltage], voltage_monitor[population_index].v[idx_voltage]/b2.mV,
-                c=color, lw=1.)
-            ax_voltage.set_ylabel("V(t) [mV]")
-            ax_voltage.set_title("Voltage Traces", fontsize=10)
+            segments.append(numpy.column_stack(
+                [ts_window, V[row_of[int(population_index)], v_mask]]))
+        colors = ["r" if i == 0 else (.7, .7, .7) for i in range(len(segments))]
+        if len(segments) > 0:
+            ax_voltage.add_collection(LineCollection(segments, colors=colors, linewidths=1.))
+            ax_voltage.autoscale()
+        ax_voltage.set_ylabel("V(t) [mV]")
+        ax_voltage.set_title("Voltage Traces", fontsize=10)
 
     plot_raster()
     plot_population_activity(avg_window_width)
     nr_neurons = len(spike_train_idx_list)
-    highlighted_neurons_i = []  # default to an empty list.
-    if N_highlighted_spiketrains > 0:
+    highlighted_neurons_i = numpy.empty(0, dtype=numpy.int64)  # default to an empty selection.
+    if N_highlighted_spiketrains > 0 and nr_neurons > 0:
         fract = numpy.linspace(0, 1, N_highlighted_spiketrains + 2)[1:-1]
-        highlighted_neurons_i = [int(nr_neurons * v) for v in fract]
+        highlighted_neurons_i = (nr_neurons * fract).astype(numpy.int64)
         highlight_raster(highlighted_neurons_i)
 
     if voltage_monitor is not None:
@@ -257,18 +379,33 @@ def plot_ISI_distribution(spike_stats, hist_nr_bins=50, xlim_max_ISI=None):
     Returns:
         the figure
     """
+    import matplotlib.pyplot as plt
+    import brian2 as b2
     from neurodynex3.tools import spike_tools
     assert isinstance(spike_stats, spike_tools.PopulationSpikeStats), \
         "spike_stats is not of type spike_tools.PopulationSpikeStats"
-    isi_ms = spike_stats.all_ISI/b2.ms
+    isi_ms = numpy.asarray(spike_stats.all_ISI/b2.ms)
 
     if xlim_max_ISI is not None:
-        lim = xlim_max_ISI/b2.ms
-        idx = isi_ms < lim
-        isi_ms = isi_ms[idx]
+        hist_max_isi = float(xlim_max_ISI/b2.ms)
+    elif isi_ms.size > 0:
+        hist_max_isi = float(numpy.max(isi_ms))
+    else:
+        hist_max_isi = 1.
 
     f = plt.figure()
-    plt.hist(isi_ms, bins=hist_nr_bins)
+    edges = numpy.linspace(0., hist_max_isi, hist_nr_bins + 1)
+    isi_hist = _get_isi_hist()
+    if isi_hist is not None:
+        # fused filter + histogram: one pass over the ISIs instead of
+        # mask, index and bin as three separate array traversals.
+        counts = isi_hist(isi_ms, hist_max_isi, hist_nr_bins)
+    else:
+        # range= lets numpy drop out-of-range ISIs while binning, so no
+        # separate filtering pass is needed; plt.hist would additionally
+        # keep the full input array alive on the Axes.
+        counts, edges = numpy.histogram(isi_ms, bins=hist_nr_bins, range=(0., hist_max_isi))
+    plt.bar(edges[:-1], counts, width=numpy.diff(edges), align="edge")
     if xlim_max_ISI is not None:
         xmax = xlim_max_ISI / b2.ms
         plt.xlim([0, xmax])
@@ -293,6 +430,9 @@ def plot_spike_train_power_spectrum(freq, mean_ps, all_ps, max_freq,
     Returns:
         the figure and the index of the random neuron for which the PS is computed: all_ps[random_neuron_index]
     """
+    import matplotlib.pyplot as plt
+    import brian2 as b2
+
     nr_neurons = len(all_ps)
     f = plt.figure()
     color = "r"
@@ -347,6 +487,9 @@ def plot_population_activity_power_spectrum(freq, ps, max_freq, average_At=None,
     Returns:
         the figure
     """
+    import matplotlib.pyplot as plt
+    import brian2 as b2
+
     first_idx_to_plot = 0 if plot_f0 else 1
     f = plt.figure()
     plt.plot(freq[first_idx_to_plot:], ps[first_idx_to_plot:], ".b")